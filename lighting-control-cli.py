@@ -1,19 +1,26 @@
 import asyncio
-import aiohttp
+import httpx
+import itertools
+import numpy as np
+import orjson
+import uvloop
 import time
 from collections import deque
+from dataclasses import dataclass, field
 from statistics import mean
+import os
+import re
+import socket
+import stat
 import sys
 import tty
 import termios
 
 BASE_URL = "http://localhost:3000"
 DEVICE_ID = "C82E4761852A"
-TEMPO = 120  # Global tempo variable
-COLORS = ["#FE00AE", "#00FFDD"]  # Global colour sequence initially [magenta, cyan]
 
 # Color palette
-NAMED_COLORS = {
+_RAW_COLORS = {
     "white": "#ffffff",
     "red": "#FF0000",
     "orange": "#FF2000",
@@ -28,13 +35,19 @@ NAMED_COLORS = {
     "magenta": "#FE00AE",
     "pink": "#FF0016"
 }
+# Lowercase names and hex codes once so lookups and comparisons are canonical
+NAMED_COLORS = {k.lower(): v.lower() for k, v in _RAW_COLORS.items()}
+_HEX_RE = re.compile(r"^#[0-9a-fA-F]{6}$")
+
+JSON_HEADERS = {"content-type": "application/json"}
 
 endpoints = {
     "get_devices": "/api/devices",
     "get_state": "/api/device/",
     "set_colour": "/api/color",
     "set_power": "/api/power",
-    "set_effect": "/api/effect"
+    "set_effect": "/api/effect",
+    "batch": "/api/batch"
 }
 
 # All supported effect names
@@ -61,98 +74,228 @@ effects = [
     "seven_color_jumping"
 ]
 
-session = None
-latency_history = deque(maxlen=50)  # Track recent latencies
+_LAT_SIZE = 50  # Number of recent latencies kept
+
+@dataclass(slots=True)
+class AppState:
+    # Runtime state shared by the loops and commands, passed around instead of module globals
+    tempo: int = 120
+    colors: list = field(default_factory=lambda: ["#fe00ae", "#00ffdd"])  # initially [magenta, cyan]
+    session: httpx.AsyncClient | None = None
+    # Recent latencies in a fixed ring buffer
+    lat_buf: np.ndarray = field(default_factory=lambda: np.empty(_LAT_SIZE))
+    lat_n: int = 0  # Number of valid samples
+    lat_head: int = 0  # Next slot to write
+    live_tasks: set = field(default_factory=set)  # Strong references so running tasks aren't garbage collected
+
+app_state = AppState()  # The single instance, passed to the loops and commands from main()
+urls = {}  # Full endpoint URLs, built once the API host is resolved
+batch_supported = True  # Cleared if the API has no batch endpoint
+cmd_queue = asyncio.Queue(maxsize=64)  # Fire-and-forget commands waiting to be sent
+_stdin_buffer = b""  # Input read past the end of the last line
+
+def _task_done(task):
+    app_state.live_tasks.discard(task)
+    # Retrieve the exception here so it's reported once instead of logged at garbage collection
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Task failed: {task.exception()!r}")
+
+def spawn(coro):
+    # Start a background task and keep it referenced until it finishes
+    task = asyncio.create_task(coro)
+    app_state.live_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
 
 def resolve_color(color_input):
-    if color_input.startswith("#"):
-        return color_input
-    return NAMED_COLORS.get(color_input.lower(), color_input)
-
-async def get_session():
-    global session
-    if session is None:
-        connector = aiohttp.TCPConnector(
-            limit=10,
-            ttl_dns_cache=300,
-            keepalive_timeout=30
+    # Returns the lowercase #rrggbb for a color name or hex code, or None if it isn't a valid color
+    ci = NAMED_COLORS.get(color_input.lower(), color_input.lower())
+    return ci if _HEX_RE.match(ci) else None
+
+async def resolve_base_url():
+    # Look up the API host once so reconnects skip getaddrinfo
+    # Only plain http is pinned to the IP, https needs the hostname for certificate checks
+    # The IP is kept for the life of the process, restart the CLI if the API host changes address
+    url = httpx.URL(BASE_URL)
+    if url.scheme != "http":
+        return url, {}
+    
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            url.host, url.port or 80, type=socket.SOCK_STREAM
         )
-        timeout = aiohttp.ClientTimeout(total=1.0)
-        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
-    return session
+    except OSError as e:
+        # Fall back to resolving on each connection so the CLI still starts
+        print(f"Warning: could not resolve {url.host} ({e!r})")
+        return url, {}
+    # Prefer IPv4, "localhost" can resolve to ::1 first while the API may only listen on IPv4
+    ip = next((info[4][0] for info in infos if info[0] == socket.AF_INET), infos[0][4][0])
+    return url.copy_with(host=ip), {"Host": url.netloc.decode()}
+
+async def open_session():
+    # Create the shared session once at startup so the first beat doesn't pay connection setup
+    base_url, headers = await resolve_base_url()
+    root = str(base_url).rstrip("/")
+    urls.update({name: httpx.URL(root + path) for name, path in endpoints.items()})
+    limits = httpx.Limits(
+        max_connections=32,
+        max_keepalive_connections=16,
+        keepalive_expiry=60.0
+    )
+    # No base_url on the client, every request passes a full URL from urls
+    app_state.session = httpx.AsyncClient(
+        headers=headers,
+        http2=True,
+        timeout=1.0,
+        limits=limits
+    )
+    return app_state.session
 
 async def close_session():
-    global session
-    if session:
-        await session.close()
-        session = None
-
-async def api_call(method, endpoint, data=None):
-    url = BASE_URL + endpoint
-    sess = await get_session()
+    if app_state.session:
+        await app_state.session.aclose()
+        app_state.session = None
+
+async def send_request(method, url, data=None):
     start = time.perf_counter()
     
     try:
         if method == "GET":
-            async with sess.get(url) as resp:
-                text = await resp.text()
+            resp = await app_state.session.get(url)
         else:  # POST
-            async with sess.post(url, json=data) as resp:
-                text = await resp.text()
+            # orjson encodes request bodies much faster than the stdlib json httpx uses
+            resp = await app_state.session.post(url, content=orjson.dumps(data), headers=JSON_HEADERS)
         
         latency = time.perf_counter() - start
-        latency_history.append(latency)
-        return text
-    except asyncio.TimeoutError:
-        print(f"Timeout on {endpoint}")
+        app_state.lat_buf[app_state.lat_head] = latency
+        app_state.lat_head = (app_state.lat_head + 1) % _LAT_SIZE
+        app_state.lat_n = min(app_state.lat_n + 1, _LAT_SIZE)
+        return resp
+    except httpx.TimeoutException:
+        print(f"Timeout on {url}")
         return None
 
+async def api_get(url):
+    resp = await send_request("GET", url)
+    return resp.text if resp is not None else None
+
+async def api_post(url, data):
+    # Commands only need the status code, so the "OK" body is never decoded
+    # The body is still read off the socket, httpx closes an HTTP/1.1 connection whose body is left unread
+    resp = await send_request("POST", url, data)
+    return resp.status_code if resp is not None else None
+
 async def get_devices():
-    return await api_call("GET", endpoints["get_devices"])
+    return await api_get(urls["get_devices"])
 
 async def get_device_state(device):
-    return await api_call("GET", endpoints["get_state"] + device)
+    return await api_get(urls["get_state"].join(device))
 
 async def set_color(color, brightness):
     data = {"id": DEVICE_ID, "color": color, "brightness": brightness}
-    result = await api_call("POST", endpoints["set_colour"], data)
-    return result == "OK"
+    return await api_post(urls["set_colour"], data) == 200
 
 async def set_power(power):
     data = {"id": DEVICE_ID, "power": power}
-    result = await api_call("POST", endpoints["set_power"], data)
-    return result == "OK"
+    return await api_post(urls["set_power"], data) == 200
 
 async def set_effect(effect, speed):
     data = {"id": DEVICE_ID, "effect": effect, "speed": speed}
-    result = await api_call("POST", endpoints["set_effect"], data)
-    return result == "OK"
+    return await api_post(urls["set_effect"], data) == 200
+
+async def api_batch(ops):
+    # Send several commands in one request, in order
+    # Falls back to one request per op if the API has no batch endpoint
+    global batch_supported
+    if batch_supported:
+        data = {"id": DEVICE_ID, "ops": ops}
+        status = await api_post(urls["batch"], data)
+        if status != 404:
+            return status == 200
+        batch_supported = False
+    
+    ok = True
+    for op in ops:
+        if op["op"] == "power":
+            ok = await set_power(op["power"]) and ok
+        elif op["op"] == "color":
+            ok = await set_color(op["color"], op["brightness"]) and ok
+        elif op["op"] == "effect":
+            ok = await set_effect(op["effect"], op["speed"]) and ok
+    return ok
+
+def queue_command(op, mode=None, **fields):
+    # Hand a command to the worker without waiting on the request
+    # Commands from a mode loop are tagged with its name so stop_all can drop them
+    try:
+        cmd_queue.put_nowait((mode, {"op": op, **fields}))
+    except asyncio.QueueFull:
+        print(f"Command queue full, dropped {op}")
+
+def coalesce(ops):
+    # Keep only the latest op of each kind, earlier ones in the same drain are already stale
+    latest = {op["op"]: i for i, op in enumerate(ops)}
+    return [op for i, op in enumerate(ops) if latest[op["op"]] == i]
+
+async def command_worker():
+    # Drain queued commands and send each drain as one batch, one batch at a time so commands land in order
+    # Commands queued while a batch is in flight are coalesced at the next drain, so a slow API can't build a backlog
+    while True:
+        ops = [(await cmd_queue.get())[1]]
+        await asyncio.sleep(0)
+        while not cmd_queue.empty():
+            ops.append(cmd_queue.get_nowait()[1])
+        
+        try:
+            await api_batch(coalesce(ops))
+        except httpx.HTTPError as e:
+            print(f"Request failed: {e!r}")
 
 async def flash_simple():
-    asyncio.create_task(set_effect("white_strobe_flash", 1))
+    queue_command("effect", effect="white_strobe_flash", speed=1)
     await asyncio.sleep(0.05)
-    asyncio.create_task(set_power(False))
+    queue_command("power", power=False)
+
+SPIN_WINDOW = 0.002  # Seconds before each cycle to busy-wait instead of sleeping
 
 # Class for scheduled timing loops
 class ScheduledLoop:
-    def __init__(self, beats_per_cycle=2, intervalOverride=None):
+    def __init__(self, state, beats_per_cycle=2, intervalOverride=None):
+        self.state = state
         self.beats_per_cycle = beats_per_cycle
         self.start_time = None
         self.cycle_num = 0
-        self.current_tempo = TEMPO
+        self.current_tempo = state.tempo
         self.interval = intervalOverride
+        self._interval_cached = None
+        self.loop = None  # Event loop whose clock all scheduling uses, set on first reset
+        self.perf_offset = 0.0  # perf_counter() minus loop.time(), taken once per reset
     
     def calculate_interval(self):
-        # Calculate interval based on current tempo
-        beat_duration = 60 / TEMPO
-        if self.interval:
-            return self.interval
-        return beat_duration * self.beats_per_cycle
+        # Calculate interval based on current tempo, cached until the timing is reset
+        if self._interval_cached is None:
+            if self.interval:
+                self._interval_cached = self.interval
+            else:
+                self._interval_cached = 60 / self.state.tempo * self.beats_per_cycle
+        return self._interval_cached
     
     def reset_timing(self):
-        # Reset timing to current moment
-        self.start_time = time.perf_counter()
+        # Reset timing to current moment, on the event loop's clock so call_at can use it directly
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.start_time = self.loop.time()
+        # uvloop's clock only ticks in 1ms steps, so precise waits use perf_counter shifted onto the loop clock
+        self.perf_offset = time.perf_counter() - self.start_time
         self.cycle_num = 0
+        self._interval_cached = None
+    
+    def lookahead(self):
+        # How early to send each cycle so the light changes on the beat rather than one request later
+        # Uses the median of recent latencies, so it adapts to network conditions as they change
+        if self.state.lat_n < 5:
+            return 0.0
+        return float(np.median(self.state.lat_buf[:self.state.lat_n]))
     
     async def wait_for_next_cycle(self):
         # Wait until the next scheduled cycle, with drift handling
@@ -160,44 +303,61 @@ class ScheduledLoop:
             self.reset_timing()
         
         interval = self.calculate_interval()
-        scheduled_time = self.start_time + (self.cycle_num * interval)
-        now = time.perf_counter()
+        beat_time = self.start_time + (self.cycle_num * interval)
+        scheduled_time = beat_time - self.lookahead()
+        now = time.perf_counter() - self.perf_offset
         
-        wait_time = scheduled_time - now
-        if wait_time > 0:
-            await asyncio.sleep(wait_time)
-        elif wait_time < -0.1:  # More than 100ms behind
-            print(f"   Resync: {-wait_time*1000:.1f}ms behind")
+        # Drift is measured against the beat itself, so a large lookahead can't trigger a resync
+        if beat_time - now < -0.1:  # More than 100ms behind
+            print(f"   Resync: {-(beat_time - now)*1000:.1f}ms behind")
             self.reset_timing()
             return False  # Signal to skip this cycle
         
+        # A send time already in the past (wait_time <= 0) fires immediately
+        wait_time = scheduled_time - now
+        if wait_time > 0:
+            if wait_time > SPIN_WINDOW + 0.001:
+                # Wake at an absolute time just short of the beat rather than sleeping for a relative delay
+                fut = self.loop.create_future()
+                handle = self.loop.call_at(scheduled_time - SPIN_WINDOW, fut.set_result, None)
+                try:
+                    await fut
+                finally:
+                    handle.cancel()  # Don't resolve a future that was cancelled with the loop
+            
+            # Spin out the last stretch for sub-millisecond accuracy, yielding so other tasks still run
+            deadline = scheduled_time + self.perf_offset
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(0)
+        
         self.cycle_num += 1
         return True
     
     def check_tempo_changed(self):
         # Check if tempo has changed and reset if needed
-        if TEMPO != self.current_tempo:
-            self.current_tempo = TEMPO
+        tempo = self.state.tempo
+        if tempo != self.current_tempo:
+            self.current_tempo = tempo
             self.reset_timing()
             interval = self.calculate_interval()
-            print(f"Tempo changed to {TEMPO} BPM, interval: {interval*1000:.1f}ms")
+            print(f"Tempo changed to {tempo} BPM, interval: {interval*1000:.1f}ms")
             return True
         return False
 
-async def color_cycle_loop(mode="fade", color=None):
+async def color_cycle_loop(state, mode="fade", color=None):
     # Determine colors to use
     if color is None:
-        colors_to_use = COLORS.copy()
+        colors_to_use = state.colors.copy()
         print(f"Using color list: {colors_to_use}")
     else:
         colors_to_use = [color]
     color_index = 0
     current_color = colors_to_use[color_index]
     
-    loop = ScheduledLoop(beats_per_cycle=2)
+    loop = ScheduledLoop(state, beats_per_cycle=2)
     interval = loop.calculate_interval()
     
-    print(f"Starting {mode} loop: {TEMPO} BPM ({mode} every 2 beats)")
+    print(f"Starting {mode} loop: {state.tempo} BPM ({mode} every 2 beats)")
     print(f"Interval: {interval*1000:.1f}ms")
     
     # Set initial state
@@ -216,8 +376,8 @@ async def color_cycle_loop(mode="fade", color=None):
         loop.check_tempo_changed()
         
         # Check if colors changed
-        if color is None and colors_to_use != COLORS:
-            colors_to_use = COLORS.copy()
+        if color is None and colors_to_use != state.colors:
+            colors_to_use = state.colors.copy()
             print(f"Colors updated: {colors_to_use}")
         
         # Wait for next cycle
@@ -227,13 +387,13 @@ async def color_cycle_loop(mode="fade", color=None):
         if mode == "fade":
             # Toggle power for fade
             power_state = not power_state
-            asyncio.create_task(set_power(power_state))
+            queue_command("power", mode, power=power_state)
             
-            # Change color when powering on
+            # Change color when powering on, queued in the same batch as the power toggle
             if power_state and len(colors_to_use) > 1:
                 color_index = (color_index + 1) % len(colors_to_use)
                 current_color = colors_to_use[color_index]
-                asyncio.create_task(set_color(current_color, 100))
+                queue_command("color", mode, color=current_color, brightness=100)
                 # print(f"Color: {current_color}")
         else:  # "switch" mode
             # Change to next Colour without fading
@@ -241,10 +401,10 @@ async def color_cycle_loop(mode="fade", color=None):
                 color_index = (color_index + 1) % len(colors_to_use)
                 current_color = colors_to_use[color_index]
             
-            asyncio.create_task(set_color(current_color, 100))
+            queue_command("color", mode, color=current_color, brightness=100)
             # print(f"Color: {current_color}")
 
-async def strobe_loop(color):
+async def strobe_loop(state, color):
     # TODO: Handle strobe colour using list of possible effects
     if color is None:
         effect_color = "white_strobe_flash"
@@ -264,10 +424,10 @@ async def strobe_loop(color):
 
     # Do not want to base strobe frequency on BPM so override loop interval
     # 0.08s interval = 80ms (period) = 12.5Hz?
-    loop = ScheduledLoop(beats_per_cycle=None, intervalOverride=0.08)
+    loop = ScheduledLoop(state, beats_per_cycle=None, intervalOverride=0.08)
     interval = loop.calculate_interval()
 
-    print(f"Starting strobe loop: {TEMPO} BPM")
+    print(f"Starting strobe loop: {state.tempo} BPM")
     print(f"Interval: {interval*1000:.1f}ms")
 
     # Warmup
@@ -279,15 +439,15 @@ async def strobe_loop(color):
         if not await loop.wait_for_next_cycle():
             continue
 
-        asyncio.create_task(set_effect("white_strobe_flash", 50))
+        queue_command("effect", "strobe", effect="white_strobe_flash", speed=50)
         # asyncio.create_task(set_power(False))
 
-async def beat_loop():
+async def beat_loop(state):
     # flash every beat
-    loop = ScheduledLoop(beats_per_cycle=1)
+    loop = ScheduledLoop(state, beats_per_cycle=1)
     interval = loop.calculate_interval()
     
-    print(f"Starting beat loop: {TEMPO} BPM")
+    print(f"Starting beat loop: {state.tempo} BPM")
     print(f"Beat interval: {interval*1000:.1f}ms")
     
     # Warmup
@@ -302,11 +462,10 @@ async def beat_loop():
             continue
         
         # Fire the beat
-        asyncio.create_task(set_effect("white_strobe_flash", 100))
+        queue_command("effect", "beat", effect="white_strobe_flash", speed=100)
         # asyncio.create_task(set_power(False))
 
-async def tap_tempo():
-    global TEMPO
+async def tap_tempo(state):
     tap_times = deque(maxlen=8)
     
     print("\n--- Tap Tempo Mode ---")
@@ -314,18 +473,35 @@ async def tap_tempo():
     print("Press any other key to exit tap mode")
     print("Tap at least 2 times to calculate tempo\n")
     
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+    keys = asyncio.Queue()
+    
+    def on_key():
+        # Timestamp in the reader callback, as close to the keypress as possible
+        now = time.perf_counter()
+        try:
+            key = os.read(fd, 1)
+        except BlockingIOError:
+            return  # Spurious wakeup, nothing to read yet
+        if not key:
+            # EOF, stop watching stdin so the reader doesn't keep firing
+            loop.remove_reader(fd)
+        keys.put_nowait((now, key))
     
-    old_settings = termios.tcgetattr(sys.stdin)
+    old_settings = termios.tcgetattr(fd)
+    was_blocking = os.get_blocking(fd)
     
     try:
-        tty.setcbreak(sys.stdin.fileno())
+        tty.setcbreak(fd)
+        os.set_blocking(fd, False)
+        loop.add_reader(fd, on_key)
         
         while True:
-            char = await loop.run_in_executor(None, sys.stdin.read, 1)
+            now, key = await keys.get()
+            char = key.decode(errors="ignore")
             
             if char.lower() == 't':
-                now = time.perf_counter()
                 tap_times.append(now)
                 
                 if len(tap_times) >= 2:
@@ -334,58 +510,236 @@ async def tap_tempo():
                     new_tempo = round(60 / avg_interval)
                     new_tempo = max(40, min(240, new_tempo))
                     
-                    TEMPO = new_tempo
-                    print(f"\r- Tempo: {TEMPO} BPM (from {len(tap_times)} taps)" + " " * 20)
+                    state.tempo = new_tempo
+                    print(f"\r- Tempo: {state.tempo} BPM (from {len(tap_times)} taps)" + " " * 20)
                 else:
                     print(f"\rTap {len(tap_times)}/2... (tap more)" + " " * 20, end="")
             else:
-                print(f"\n\nExited tempo tapper. Final tempo: {TEMPO} BPM")
+                print(f"\n\nExited tempo tapper. Final tempo: {state.tempo} BPM")
                 break
     finally:
-        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
+        loop.remove_reader(fd)
+        os.set_blocking(fd, was_blocking)
+        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+
+async def read_line(prompt):
+    # Read a line from stdin on the event loop instead of blocking an executor thread
+    global _stdin_buffer
+    print(prompt, end="", flush=True)
+    loop = asyncio.get_running_loop()
+    fd = sys.stdin.fileno()
+    # Regular files can't be watched with add_reader, but reading them never blocks
+    is_file = stat.S_ISREG(os.fstat(fd).st_mode)
+    
+    while b"\n" not in _stdin_buffer:
+        if not is_file:
+            ready = loop.create_future()
+            loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+        
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            # Return a final line that has no trailing newline before reporting EOF
+            if _stdin_buffer:
+                line, _stdin_buffer = _stdin_buffer, b""
+                return line.decode(errors="ignore")
+            raise EOFError
+        _stdin_buffer += chunk
+    
+    line, _, _stdin_buffer = _stdin_buffer.partition(b"\n")
+    return line.decode(errors="ignore")
 
-def get_latency_stats():
-    if not latency_history:
+def get_latency_stats(state):
+    if not state.lat_n:
         return "No latency data yet"
     
-    avg = sum(latency_history) / len(latency_history)
-    min_lat = min(latency_history)
-    max_lat = max(latency_history)
+    samples = state.lat_buf[:state.lat_n]
+    avg = np.mean(samples)
+    min_lat = np.min(samples)
+    max_lat = np.max(samples)
     
     return f"Latency: avg={avg*1000:.1f}ms, min={min_lat*1000:.1f}ms, max={max_lat*1000:.1f}ms"
 
-# TODO: make this accept [tasks] and end them all
-def stop_all_tasks(beat_task, fade_task, switch_task, strobe_task):
-    stopped = []
-    if beat_task:
-        beat_task.cancel()
-        stopped.append("beat")
-    if fade_task:
-        fade_task.cancel()
-        stopped.append("fade")
-    if switch_task:
-        switch_task.cancel()
-        stopped.append("switch")
-    if strobe_task:
-        strobe_task.cancel()
-        stopped.append("strobe")
-    if stopped:
-        print(f"Stopped: {', '.join(stopped)}")
-    
-    return None, None, None, None
-
-async def interactive_mode():
-    global TEMPO, COLORS
-    
-    i = 0
+async def stop_all(modes):
+    # Cancel every running mode loop and wait for them to finish, so none fire after a new mode starts
+    if not modes:
+        return
+    for task in modes.values():
+        task.cancel()
+    await asyncio.gather(*modes.values(), return_exceptions=True)
+    
+    # Drop commands the stopped loops queued that the worker hasn't sent yet, keeping the rest in order
+    pending = []
+    while not cmd_queue.empty():
+        pending.append(cmd_queue.get_nowait())
+    for item in pending:
+        if item[0] not in modes:
+            cmd_queue.put_nowait(item)
+    
+    print(f"Stopped: {', '.join(modes)}")
+    modes.clear()
+
+async def interactive_mode(state):
+    effect_cycle = itertools.cycle(effects)
     power = False
     strobe = False
-    beat_task = None
-    fade_task = None
-    switch_task = None
-    strobe_task = None
+    modes = {}  # Running mode loop tasks by name
 
-    previous_tasks = [fade_task != None, switch_task != None]
+    previous_modes = set()
+    
+    # Command handlers take the split command and return True to quit
+    async def handle_quit(parts):
+        return True
+    
+    async def handle_effect(parts):
+        effect = next(effect_cycle)
+        queue_command("effect", effect=effect, speed=100)
+        print(f"Effect: {effect}")
+    
+    async def handle_power(parts):
+        nonlocal power
+        queue_command("power", power=power)
+        power = not power
+        print(f"Power: {'ON' if power else 'OFF'}")
+    
+    def color_arg(parts):
+        # Optional color argument, returns (False, None) if one was given but isn't a valid color
+        if len(parts) < 2:
+            return True, None
+        color = resolve_color(parts[1])
+        if color is None:
+            print(f"Invalid color: {parts[1]}")
+            return False, None
+        return True, color
+    
+    async def handle_color(parts):
+        color = resolve_color(parts[0])
+        queue_command("color", color=color, brightness=100)
+        print(f"Color set to: {color}")
+    
+    async def handle_flash(parts):
+        # TODO: allow flash colours
+        spawn(flash_simple())
+        print("Flash")
+    
+    async def handle_strobe(parts):
+        nonlocal strobe, previous_modes
+        valid, color = color_arg(parts)
+        if not valid:
+            return
+        # toggle
+        strobe = not strobe
+        if strobe:
+            # save effect loop currently running, to restart when toggled off
+            previous_modes = set(modes)
+        
+        await stop_all(modes)
+        if strobe:
+            print("Strobe ON")
+            modes["strobe"] = spawn(strobe_loop(state, color))
+        else:
+            print("Strobe OFF")
+            if "fade" in previous_modes:
+                modes["fade"] = spawn(color_cycle_loop(state, "fade"))
+            elif "switch" in previous_modes:
+                modes["switch"] = spawn(color_cycle_loop(state, "switch"))
+    
+    async def handle_fade(parts):
+        valid, color = color_arg(parts)
+        if not valid:
+            return
+        await stop_all(modes)
+        modes["fade"] = spawn(color_cycle_loop(state, "fade", color))
+    
+    async def handle_switch(parts):
+        valid, color = color_arg(parts)
+        if not valid:
+            return
+        await stop_all(modes)
+        modes["switch"] = spawn(color_cycle_loop(state, "switch", color))
+    
+    async def handle_colors(parts):
+        if len(parts) > 1:
+            resolved = [resolve_color(p) for p in parts[1:]]
+            new_colors = [c for c in resolved if c is not None]
+            if new_colors:
+                state.colors = new_colors
+                print(f"Colors set to: {state.colors}")
+            else:
+                print("Invalid colors. Use color names or hex codes like: colors red green blue")
+        else:
+            print(f"Current colors: {state.colors}")
+    
+    async def handle_palette(parts):
+        print("\nAvailable color names:")
+        for name, hex_code in sorted(NAMED_COLORS.items()):
+            print(f"  {name:12} - {hex_code}")
+        print()
+    
+    async def handle_beat(parts):
+        await stop_all(modes)
+        modes["beat"] = spawn(beat_loop(state))
+    
+    async def handle_tap(parts):
+        await tap_tempo(state)
+    
+    async def handle_tempo(parts):
+        if len(parts) > 1:
+            try:
+                new_tempo = int(parts[1])
+                if 40 <= new_tempo <= 240:
+                    state.tempo = new_tempo
+                    print(f"Tempo set to {state.tempo} BPM")
+                else:
+                    print("Tempo must be between 40 and 240 BPM")
+            except ValueError:
+                print("Invalid tempo value")
+        else:
+            print(f"Current tempo: {state.tempo} BPM")
+    
+    async def handle_double_tempo(parts):
+        newTempo = state.tempo * 2
+        state.tempo = newTempo
+        print(f"New tempo: {state.tempo}")
+    
+    async def handle_half_tempo(parts):
+        newTempo = state.tempo / 2
+        state.tempo = newTempo
+        print(f"New tempo: {state.tempo}")
+    
+    async def handle_stop(parts):
+        await stop_all(modes)
+        queue_command("power", power=False)
+    
+    async def handle_stats(parts):
+        print(get_latency_stats(state))
+    
+    # Exact-match commands
+    commands = {
+        "q": handle_quit,
+        "e": handle_effect,
+        "p": handle_power,
+        "f": handle_flash,
+        "s": handle_strobe,
+        "palette": handle_palette,
+        "beat": handle_beat,
+        "tap": handle_tap,
+        "]": handle_double_tempo,
+        "[": handle_half_tempo,
+        "stop": handle_stop,
+        "stats": handle_stats,
+        # TODO: help - print help message
+    }
+    # Commands that take arguments, matched on the first word
+    arg_commands = {
+        "fade": handle_fade,
+        "switch": handle_switch,
+        "colors": handle_colors,
+        "tempo": handle_tempo,
+    }
     
     print("Commands:")
     print("  e - cycle effects")
@@ -407,122 +761,39 @@ async def interactive_mode():
     print("  help - show help command (TODO)")
     print("  q - quit")
     print()
-    print(f"Current tempo: {TEMPO} BPM")
-    print(f"Current colors: {COLORS}")
+    print(f"Current tempo: {state.tempo} BPM")
+    print(f"Current colors: {state.colors}")
     print()
     
-    loop = asyncio.get_event_loop()
-    
     while True:
-        command = await loop.run_in_executor(None, input, "\n$: ")
+        command = await read_line("\n$: ")
         command = command.strip()
+        parts = command.split()
         
-        if command == "q":
-            break
-        elif command == "e":
-            asyncio.create_task(set_effect(effects[i % len(effects)], 100))
-            i += 1
-            print(f"Effect: {effects[(i-1) % len(effects)]}")
-        elif command == "p":
-            asyncio.create_task(set_power(power))
-            power = not power
-            print(f"Power: {'ON' if power else 'OFF'}")
-        elif command.startswith("#") or command.lower() in NAMED_COLORS:
-            color = resolve_color(command)
-            asyncio.create_task(set_color(color, 100))
-            print(f"Color set to: {color}")
-        elif command == "f":
-            # TODO: allow flash colours
-            asyncio.create_task(flash_simple())
-            print("Flash")
-        elif command == "s":
-            parts = command.split()
-            color = resolve_color(parts[1]) if len(parts) > 1 else None
-            # toggle
-            strobe = not strobe
-            if strobe:
-                # save effect loop currently running, to restart when toggled off
-                previous_tasks = [fade_task != None, switch_task != None]
-            
-            beat_task, fade_task, switch_task, strobe_task = stop_all_tasks(beat_task, fade_task, switch_task, strobe_task)
-            if strobe:
-                print("Strobe ON")
-                strobe_task = asyncio.create_task(strobe_loop(color))
-            else:
-                print("Strobe OFF")
-                if previous_tasks[0]:
-                    fade_task = asyncio.create_task(color_cycle_loop("fade"))
-                elif previous_tasks[1]:
-                    switch_task = asyncio.create_task(color_cycle_loop("switch"))
-            
-        elif command.startswith("fade"):
-            parts = command.split()
-            color = resolve_color(parts[1]) if len(parts) > 1 else None
-            beat_task, fade_task, switch_task, strobe_task = stop_all_tasks(beat_task, fade_task, switch_task, strobe_task)
-            fade_task = asyncio.create_task(color_cycle_loop("fade", color))
-        elif command.startswith("switch"):
-            parts = command.split()
-            color = resolve_color(parts[1]) if len(parts) > 1 else None
-            beat_task, fade_task, switch_task, strobe_task = stop_all_tasks(beat_task, fade_task, switch_task, strobe_task)
-            switch_task = asyncio.create_task(color_cycle_loop("switch", color))
-        elif command.startswith("colors"):
-            parts = command.split()
-            if len(parts) > 1:
-                new_colors = [resolve_color(c) for c in parts[1:]]
-                new_colors = [c for c in new_colors if c.startswith("#")]
-                if new_colors:
-                    COLORS = new_colors
-                    print(f"Colors set to: {COLORS}")
-                else:
-                    print("Invalid colors. Use color names or hex codes like: colors red green blue")
-            else:
-                print(f"Current colors: {COLORS}")
-        elif command == "palette":
-            print("\nAvailable color names:")
-            for name, hex_code in sorted(NAMED_COLORS.items()):
-                print(f"  {name:12} - {hex_code}")
-            print()
-        elif command == "beat":
-            beat_task, fade_task, switch_task, strobe_task = stop_all_tasks(beat_task, fade_task, switch_task, strobe_task)
-            beat_task = asyncio.create_task(beat_loop())
-        elif command == "tap":
-            await tap_tempo()
-        elif command.startswith("tempo"):
-            parts = command.split()
-            if len(parts) > 1:
-                try:
-                    new_tempo = int(parts[1])
-                    if 40 <= new_tempo <= 240:
-                        TEMPO = new_tempo
-                        print(f"Tempo set to {TEMPO} BPM")
-                    else:
-                        print("Tempo must be between 40 and 240 BPM")
-                except ValueError:
-                    print("Invalid tempo value")
-            else:
-                print(f"Current tempo: {TEMPO} BPM")
-        elif command == "]":
-            newTempo = TEMPO * 2
-            TEMPO = newTempo
-            print(f"New tempo: {TEMPO}")
-        elif command == "[":
-            newTempo = TEMPO / 2
-            TEMPO = newTempo
-            print(f"New tempo: {TEMPO}")
-        elif command == "stop":
-            beat_task, fade_task, switch_task, strobe_task = stop_all_tasks(beat_task, fade_task, switch_task, strobe_task)
-            asyncio.create_task(set_power(False))
-        elif command == "stats":
-            print(get_latency_stats())
-        # TODO: help - print help message
-        else:
+        handler = commands.get(command)
+        if handler is None and parts:
+            handler = arg_commands.get(parts[0])
+        if handler is None and resolve_color(command) is not None:
+            handler = handle_color
+        
+        if handler is None:
             print("Unknown command")
+        elif await handler(parts):
+            break
 
 async def main():
+    await open_session()
+    worker = spawn(command_worker())
     try:
-        await interactive_mode()
+        # Prewarm the connection pool before any loop starts, best-effort so the CLI still starts without the API
+        try:
+            await get_devices()
+        except httpx.HTTPError as e:
+            print(f"Warning: could not reach API at {BASE_URL} ({e!r})")
+        await interactive_mode(app_state)
     finally:
+        worker.cancel()
         await close_session()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    uvloop.run(main())
\ No newline at end of file